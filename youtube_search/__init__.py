@@ -4,7 +4,7 @@
 __author__ = 'Chris Pedro'
 __copyright__ = '(c) Chris Pedro 2020'
 __licence__ = 'MIT'
-__version__ = '0.3.0'
+__version__ = '0.4.0'
 
-from .core import YouTubeSearch
+from .core import Channel, Upload, YouTubeSearch, dumps, is_transient_error
 
@@ -9,14 +9,170 @@ __copyright__ = '(c) Chris Pedro 2020'
 __licence__ = 'MIT'
 
 
-import googleapiclient.discovery
+import collections
+import concurrent.futures
+import contextlib
 import googleapiclient.errors
+import itertools
+import mmap
+import orjson
 import os
 import pickle
+import random
+import sqlite3
+import time
 
 from .settings import Settings
 from datetime import datetime, timedelta, timezone
-from google_auth_oauthlib.flow import InstalledAppFlow
+from google.oauth2.credentials import Credentials
+
+
+# Maximum number of requests to send in a single batch request.
+BATCH_SIZE = 50
+# Minimum size of a state file, in bytes, to memory map it when loading.
+MMAP_MIN_SIZE = 64 * 1024
+# First byte of files pickled with protocol 2 or later.
+PICKLE_PROTO = b'\x80'
+# Number of attempts to add a video to a playlist before giving up, and the
+# HTTP statuses worth trying again.
+MAX_ATTEMPTS = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of at most size items.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# An uploaded video, projected from the API's activity resource.
+Upload = collections.namedtuple(
+    'Upload', 'video_id published_at channel_title')
+
+
+class Channel(collections.namedtuple('Channel', 'channel_id title')):
+    """A subscribed channel, projected from the API's subscription resource.
+    """
+
+    __slots__ = ()
+
+    @property
+    def uploads_playlist_id(self):
+        """The channel's uploads playlist.  Its ID is the channel ID with the
+        'UC' prefix swapped for 'UU'.
+        """
+        return 'UU' + self.channel_id[2:]
+
+
+def _channel(sub):
+    """Get a channel from a saved subscription.
+    """
+    # Backwards compatibility w/ <v0.4.0 when the subscription's snippet was
+    # saved.
+    if isinstance(sub, dict):
+        return Channel(sub['resourceId']['channelId'], sub['title'])
+    return Channel(*sub)
+
+
+def _uploads_from_activities(activities):
+    """Get uploads from an activities list response.  Activities also include
+    likes, playlist additions, etc.  Only keep uploads.
+    """
+    return [
+        Upload(
+            activity['contentDetails']['upload']['videoId'],
+            activity['snippet']['publishedAt'],
+            activity['snippet']['channelTitle'])
+        for activity in activities['items']
+        if activity['snippet']['type'] == 'upload']
+
+
+def is_transient_error(exception):
+    """Check if an exception from a request is worth trying again.
+    """
+    if not isinstance(exception, googleapiclient.errors.HttpError):
+        return False
+    # Batch errors, such as a malformed response, can come without a
+    # response, so there's no status to retry on.
+    resp = getattr(exception, 'resp', None)
+    return resp is not None and resp.status in RETRY_STATUSES
+
+
+def dumps(obj):
+    """Dump an object to a JSON string.  Datetimes are dumped in ISO 8601
+    format, naive ones as UTC, and named tuples, such as channels and
+    uploads, as objects.
+    """
+    return orjson.dumps(
+        obj, default=lambda o: o._asdict(),
+        option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z).decode()
+
+
+def _load_state(path):
+    """Load a JSON state file.  Large files are memory mapped and decoded in
+    place, instead of being copied into memory first.
+    """
+    with open(path, 'rb') as fp:
+        # For small files, mapping costs more than the copy it saves.
+        if os.fstat(fp.fileno()).st_size < MMAP_MIN_SIZE:
+            return _decode_state(path, fp.read())
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as data:
+            return _decode_state(path, data)
+
+
+def _decode_state(path, data):
+    """Decode the contents of a JSON state file.
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError as e:
+        # Backwards compatibility w/ <v0.4.0 when state files were pickled,
+        # they're saved as JSON from then on.  Only unpickle files that start
+        # with a pickle protocol marker, anything else is a broken file.
+        if bytes(data[:1]) != PICKLE_PROTO:
+            raise ValueError(f'Invalid state file {path}: {e}') from None
+        return pickle.loads(data)
+
+
+def _save_state(path, state):
+    """Save a JSON state file.
+    """
+    _write_file(path, orjson.dumps(state))
+
+
+def _write_file(path, data):
+    """Write data to a file atomically.  Data is written to a temporary file
+    first, then moved over the original, so a crash never leaves a partially
+    written file behind.
+    """
+    tmp_path = path + '.tmp'
+    # O_BINARY only exists, and is only needed, on Windows.
+    flags = (os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+             | getattr(os, 'O_BINARY', 0))
+    fd = os.open(tmp_path, flags, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+
+def _parse_time(value):
+    """Parse a time saved in a state file.  Pickled state files saved the
+    datetime itself.
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
 
 
 class YouTubeSearch(object):
@@ -24,35 +180,50 @@ class YouTubeSearch(object):
     playlists.
     """
 
+    __slots__ = (
+        '_settings', '_secrets_file', '_client', '_credentials',
+        '_saved_token', '_state')
+
     def __init__(self, secrets_file='client_id.json'):
-        """Authenticate to YouTube.  This will try and load saved credentials
-        first and if it's not successful it will prompt the user for access and
-        save credentials for the next run.
+        """Set up settings and the configuration directory.  Authenticating to
+        YouTube and building the API client is left until the client is first
+        used, so saved state can be read without either.
         """
         self._settings = Settings()
+        self._secrets_file = secrets_file
+        self._client = None
+        self._credentials = None
+        self._saved_token = None
+        self._state = {}
         # Create configuration directory if it doesn't exist.
         if not os.path.exists(self.settings.config_path):
             os.makedirs(self.settings.config_path)
 
-        try:
-            creds = self.load_credentials()
-            self.build_client(creds)
-            # Try and list 'my' channel, if this fails, will re-auth.
-            request = self.client.channels().list(
-                part="snippet,statistics",
-                mine=True)
-            request.execute()
-        except Exception:
-            creds = self.auth_client(secrets_file)
-            self.build_client(creds)
-            self.save_credentials(creds)
-
     @property
     def client(self):
-        """YouTube client to use for all API calls.
+        """YouTube client to use for all API calls.  Connects on first use.
         """
+        if self._client is None:
+            self.connect()
         return self._client
 
+    def connect(self):
+        """Authenticate to YouTube and build the API client.  This will try and
+        load saved credentials first and if it's not successful it will prompt
+        the user for access and save credentials for the next run.
+        """
+        try:
+            creds = self.load_credentials()
+            # Refresh expired credentials up front, if this fails, will
+            # re-auth.  Valid credentials don't need an API call to check.
+            if not creds.valid:
+                self.refresh_credentials(creds)
+                self.save_credentials(creds)
+        except Exception:
+            creds = self.auth_client(self._secrets_file)
+            self.save_credentials(creds)
+        self.build_client(creds)
+
     @property
     def settings(self):
         """Settings to use.
@@ -63,38 +234,90 @@ class YouTubeSearch(object):
         """Authenticate against YouTube's API and return the credentials
         captured.
         """
+        # Imported here, it is only needed the first time the user authorises.
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_secrets_file(
             secrets_file, self.settings.api_scopes)
         return flow.run_console()
 
+    def refresh_credentials(self, creds):
+        """Refresh credentials using their refresh token.  Raises
+        google.auth.exceptions.RefreshError if they can't be refreshed.
+        """
+        import google_auth_httplib2
+        import httplib2
+
+        creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+
     def build_client(self, creds):
         """Build the API client to use.  This requires credentials to use.
         """
+        # Imported here, it is slow to import and only needed to make API
+        # calls.
+        import googleapiclient.discovery
+
+        self._credentials = creds
+        # Use the discovery document bundled with the client library, instead
+        # of fetching it from Google on every run.  All requests made through
+        # the client share one connection, kept alive between requests.
         self._client = googleapiclient.discovery.build(
             self.settings.api_service_name, self.settings.api_version,
-            credentials=creds)
+            http=self.new_http(), static_discovery=True,
+            cache_discovery=False)
+
+    def new_http(self):
+        """Build a new authorised HTTP connection.  httplib2 is not thread
+        safe, so each thread making requests needs its own.
+        """
+        import google_auth_httplib2
+        import httplib2
+
+        return google_auth_httplib2.AuthorizedHttp(
+            self._credentials, http=httplib2.Http())
 
     def load_credentials(self):
-        """Load saved credentials from file.
+        """Load saved credentials from file.  Credentials are kept in memory
+        after the first load.
         """
-        with open(self.settings.credentials_file, 'rb') as fp:
-            return pickle.load(fp)
+        if self._credentials is None:
+            creds = _load_state(self.settings.credentials_file)
+            # Credentials pickled by <v0.4.0 load as they are, otherwise build
+            # them from the saved JSON.
+            if not isinstance(creds, Credentials):
+                info = creds
+                creds = Credentials.from_authorized_user_info(
+                    info, info.get('scopes'))
+            self._credentials = creds
+            self._saved_token = creds.token
+        return self._credentials
 
     def save_credentials(self, credentials):
-        """Save credentials to file.
+        """Save credentials to file.  Skips the write if the token hasn't
+        changed since it was last loaded or saved.
         """
-        with open(self.settings.credentials_file, 'wb') as fp:
-            pickle.dump(credentials, fp, pickle.HIGHEST_PROTOCOL)
+        if credentials.token == self._saved_token:
+            return
+        _write_file(
+            self.settings.credentials_file,
+            credentials.to_json().encode('utf-8'))
+        self._credentials = credentials
+        self._saved_token = credentials.token
 
     def load_last_run(self):
         """Load last run time from file.
         """
         try:
-            with open(self.settings.last_run_file, 'rb') as fp:
-                last_run = pickle.load(fp)
-                # Backwards compatibility w/ <0.0.2 when last_run was datetime.
-                if isinstance(last_run, datetime):
-                    last_run = {'found_videos': [], 'last_run': last_run}
+            last_run = self._read_state(self.settings.last_run_file)
+            # Backwards compatibility w/ <0.0.2 when last_run was datetime.
+            if isinstance(last_run, datetime):
+                last_run = {'found_videos': [], 'last_run': last_run}
+            last_run['last_run'] = _parse_time(last_run['last_run'])
+            # Backwards compatibility w/ <v0.4.0 when found videos were saved
+            # in the last run file, as the videos' content details.
+            last_run['found_videos'] = [
+                v['videoId'] if isinstance(v, dict) else v
+                for v in last_run.get('found_videos', [])]
         except FileNotFoundError:
             # If there is no last run, tell program it was X days ago.
             last_run = {
@@ -103,48 +326,106 @@ class YouTubeSearch(object):
                     days=self.settings.last_run_days_ago)}
         return last_run
 
-    def save_last_run(self, found_videos):
+    def save_last_run(self):
         """Save 'last run', which is just the current time to file.
         """
-        last_run = {
-            'last_run': datetime.now(timezone.utc),
-            'found_videos': found_videos}
-        with open(self.settings.last_run_file, 'wb') as fp:
-            pickle.dump(last_run, fp, pickle.HIGHEST_PROTOCOL)
+        last_run = {'last_run': datetime.now(timezone.utc).isoformat()}
+        self._write_state(self.settings.last_run_file, last_run)
+
+    def migrate_seen_videos(self):
+        """Move the IDs of found videos from the last run file to the
+        database.
+        """
+        # Backwards compatibility w/ <v0.4.0 when found videos were saved in
+        # the last run file.
+        found_videos = self.load_last_run()['found_videos']
+        if found_videos:
+            self.save_seen_videos(found_videos)
+
+    def load_seen_videos(self):
+        """Load the IDs of videos found in previous runs.  The database is
+        only read, and isn't created if it doesn't exist yet.
+        """
+        if not os.path.exists(self.settings.seen_db_file):
+            return set()
+        with contextlib.closing(
+                sqlite3.connect(self.settings.seen_db_file)) as db:
+            return {row[0] for row in db.execute('SELECT video_id FROM seen')}
+
+    def save_seen_videos(self, video_ids):
+        """Save the IDs of videos found in this run.  Only new IDs are added,
+        previously found ones are left as they are.
+        """
+        added_at = datetime.now(timezone.utc).isoformat()
+        with contextlib.closing(self._connect_seen_db()) as db, db:
+            db.executemany(
+                'INSERT OR IGNORE INTO seen (video_id, added_at) '
+                'VALUES (?, ?)',
+                ((video_id, added_at) for video_id in video_ids))
+
+    def _connect_seen_db(self):
+        """Connect to the database of found videos, creating it if needed.
+        """
+        db = sqlite3.connect(self.settings.seen_db_file)
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS seen '
+            '(video_id TEXT PRIMARY KEY, added_at TEXT)')
+        return db
 
     def load_dest_playlist(self):
         """Load plalists from file.
         """
         try:
-            with open(self.settings.dest_pl_file, 'rb') as fp:
-                return pickle.load(fp)
+            pl_info = self._read_state(self.settings.dest_pl_file)
         except FileNotFoundError:
             return None
+        pl_info['last_update'] = _parse_time(pl_info['last_update'])
+        return pl_info
 
     def save_dest_playlist(self, pl_id, pl_name):
         """Save playslists to file.
         """
         pl_info = {
-            'last_update': datetime.now(timezone.utc),
+            'last_update': datetime.now(timezone.utc).isoformat(),
             'name': pl_name,
             'id': pl_id}
-        with open(self.settings.dest_pl_file, 'wb') as fp:
-            pickle.dump(pl_info, fp, pickle.HIGHEST_PROTOCOL)
+        self._write_state(self.settings.dest_pl_file, pl_info)
 
     def load_subscriptions(self):
         """Load subscriptions from file.
         """
-        with open(self.settings.subs_file, 'rb') as fp:
-            return pickle.load(fp)
+        sub_info = self._read_state(self.settings.subs_file)
+        if isinstance(sub_info, dict):
+            sub_info['subscriptions'] = [
+                _channel(sub) for sub in sub_info['subscriptions']]
+            # Backwards compatibility w/ <v0.2.0, no last update saved.
+            if 'last_update' in sub_info:
+                sub_info['last_update'] = _parse_time(
+                    sub_info['last_update'])
+        return sub_info
 
     def save_subscriptions(self, subs):
-        """Save subscribers to file.
+        """Save subscribers to file.  Channels are saved as compact
+        [channel_id, title] pairs.
         """
         sub_info = {
-            'last_update': datetime.now(timezone.utc),
-            'subscriptions': subs}
-        with open(self.settings.subs_file, 'wb') as fp:
-            pickle.dump(sub_info, fp, pickle.HIGHEST_PROTOCOL)
+            'last_update': datetime.now(timezone.utc).isoformat(),
+            'subscriptions': [list(sub) for sub in subs]}
+        self._write_state(self.settings.subs_file, sub_info)
+
+    def _read_state(self, path):
+        """Read a state file.  Its contents are kept in memory, so each file
+        is only read from disk once.
+        """
+        if path not in self._state:
+            self._state[path] = _load_state(path)
+        return self._state[path]
+
+    def _write_state(self, path, state):
+        """Write a state file, and keep its contents in memory.
+        """
+        _save_state(path, state)
+        self._state[path] = state
 
     def get_user_playlists(self):
         """Get list of user's playlists.
@@ -155,16 +436,16 @@ class YouTubeSearch(object):
 
         while True:
             request = self.client.playlists().list(
-                part='snippet,contentDetails',
+                part='snippet',
+                fields='nextPageToken,items(id,snippet/title)',
                 pageToken=next_page,
                 maxResults=max_results,
                 mine=True)
             playlists_list = request.execute()
             playlists.extend(p for p in playlists_list['items'])
 
-            try:
-                next_page = playlists_list('nextPageToken')
-            except BaseException:
+            next_page = playlists_list.get('nextPageToken')
+            if not next_page:
                 break
 
         return playlists
@@ -179,51 +460,126 @@ class YouTubeSearch(object):
         # First get all subscriptions.
         while True:
             request = self.client.subscriptions().list(
-                part='snippet,contentDetails',
+                part='snippet',
+                fields=('nextPageToken,'
+                        'items/snippet(title,resourceId/channelId)'),
                 pageToken=next_page,
                 maxResults=max_results,
                 mine=True)
             sub_list = request.execute()
 
-            subs.extend(sub['snippet'] for sub in sub_list['items'])
+            subs.extend(
+                Channel(
+                    sub['snippet']['resourceId']['channelId'],
+                    sub['snippet']['title'])
+                for sub in sub_list['items'])
 
-            try:
-                next_page = sub_list['nextPageToken']
-            except BaseException:
+            next_page = sub_list.get('nextPageToken')
+            if not next_page:
                 break
 
-        # Next loop through subs and get their public playlists.
-        for sub in subs:
-            request = self.client.channels().list(
-                part='contentDetails',
-                id=sub['resourceId']['channelId'])
-            channel_info = request.execute()
-            content_details = channel_info['items'][0]['contentDetails']
-            sub['playlists'] = content_details['relatedPlaylists']
-
         return subs
 
-    def get_channel_uploads(self, channel):
-        """Get last 10 uploads from a channel.
+    def _channel_uploads_request(self, channel, published_after,
+                                 page_token=''):
+        """Build the request for a page of uploads from a channel published
+        after a given time.
         """
-        # Only get the last 10 uploads.
-        max_results = 10
+        # Let the API filter on publish time, most channels won't have any new
+        # activity and will return no items at all.
+        max_results = 50
 
-        request = self.client.playlistItems().list(
-            part='contentDetails',
-            maxResults=max_results,
-            playlistId=channel['playlists']['uploads'])
-        try:
-            uploads = request.execute()
-        # Catch for channels with no uploads.
-        except googleapiclient.errors.HttpError:
-            return []
-        return uploads['items']
+        return self.client.activities().list(
+            part='snippet,contentDetails',
+            fields=('nextPageToken,'
+                    'items(snippet(publishedAt,channelTitle,type),'
+                    'contentDetails/upload/videoId)'),
+            channelId=channel.channel_id,
+            publishedAfter=published_after.astimezone(timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'),
+            pageToken=page_token,
+            maxResults=max_results)
+
+    def get_channel_uploads(self, channel, published_after):
+        """Get uploads from a channel published after a given time.  Uploads
+        are yielded as each page is fetched, so callers that stop early never
+        request the remaining pages.
+        """
+        next_page = ''
 
-    def add_video_to_playlist(self, video_id, playlist):
-        """Add a video to a playlist.
+        while True:
+            request = self._channel_uploads_request(
+                channel, published_after, next_page)
+            try:
+                activities = request.execute()
+            # Catch for channels that no longer exist.
+            except googleapiclient.errors.HttpError:
+                return
+            yield from _uploads_from_activities(activities)
+
+            next_page = activities.get('nextPageToken')
+            if not next_page:
+                return
+
+    def get_channels_uploads(self, channels, published_after,
+                             max_workers=None):
+        """Get uploads from a list of channels published after a given time.
+        Requests are sent in batches, up to max_workers batches at a time
+        (default from settings), and uploads are returned in a dict keyed by
+        channel ID.
+        """
+        if max_workers is None:
+            max_workers = self.settings.max_workers
+        channels_by_id = {c.channel_id: c for c in channels}
+        uploads = {channel_id: [] for channel_id in channels_by_id}
+        next_pages = {}
+
+        def callback(request_id, response, exception):
+            # Catch for channels that no longer exist.
+            if exception is not None:
+                return
+            uploads[request_id].extend(_uploads_from_activities(response))
+            if response.get('nextPageToken'):
+                next_pages[request_id] = response['nextPageToken']
+
+        def execute(batch):
+            try:
+                batch.execute(http=self.new_http())
+            # Catch for batches that fail as a whole, their channels are
+            # treated as having no uploads, same as a failed request.
+            except googleapiclient.errors.HttpError:
+                pass
+
+        # Fetch the first page for every channel, then the next page for the
+        # few channels with more uploads, until there are no more pages.
+        pages = {channel_id: '' for channel_id in channels_by_id}
+        while pages:
+            batches = []
+            for chunk in _chunks(pages.items(), BATCH_SIZE):
+                batch = self.client.new_batch_http_request(callback=callback)
+                for channel_id, page_token in chunk:
+                    batch.add(
+                        self._channel_uploads_request(
+                            channels_by_id[channel_id], published_after,
+                            page_token),
+                        request_id=channel_id)
+                batches.append(batch)
+
+            # Batches are independent of each other, so send them
+            # concurrently.
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers) as executor:
+                list(executor.map(execute, batches))
+
+            pages = next_pages
+            next_pages = {}
+
+        return uploads
+
+    def _add_video_request(self, video_id, playlist):
+        """Build the request to add a video to a playlist.
         """
-        request = self.client.playlistItems().insert(
+        return self.client.playlistItems().insert(
             part='snippet',
             body={
                 'snippet': {
@@ -231,7 +587,51 @@ class YouTubeSearch(object):
                     'resourceId': {
                         'kind': 'youtube#video',
                         'videoId': video_id}}})
-        return request.execute()
+
+    def add_video_to_playlist(self, video_id, playlist):
+        """Add a video to a playlist.
+        """
+        return self._add_video_request(video_id, playlist).execute()
+
+    def add_videos_to_playlist(self, video_ids, playlist):
+        """Add a list of videos to a playlist.  Requests are sent in batches,
+        and a dict is returned of video ID to the exception raised adding it,
+        or None if it was added.  Transient errors are retried with
+        exponential backoff.
+        """
+        errors = {}
+        pending = list(video_ids)
+
+        for attempt in range(MAX_ATTEMPTS):
+            retry = []
+
+            def callback(request_id, response, exception):
+                errors[request_id] = exception
+                if is_transient_error(exception):
+                    retry.append(request_id)
+
+            for chunk in _chunks(pending, BATCH_SIZE):
+                batch = self.client.new_batch_http_request(callback=callback)
+                for video_id in chunk:
+                    batch.add(
+                        self._add_video_request(video_id, playlist),
+                        request_id=video_id)
+                try:
+                    batch.execute()
+                # Catch for batches that fail as a whole, every video in the
+                # batch gets the batch's error.
+                except googleapiclient.errors.HttpError as e:
+                    for video_id in chunk:
+                        callback(video_id, None, e)
+
+            if not retry or attempt == MAX_ATTEMPTS - 1:
+                break
+
+            # Wait 1, 2, 4... seconds, plus jitter, before trying again.
+            time.sleep(2 ** attempt + random.random())
+            pending = retry
+
+        return errors
 
     def get_playlist_items(self, playlist_id):
         """Get list of items in a playlist.
@@ -249,9 +649,8 @@ class YouTubeSearch(object):
             items_list = request.execute()
             playlist_items.extend(p for p in items_list['items'])
 
-            try:
-                next_page = items_list('nextPageToken')
-            except BaseException:
+            next_page = items_list.get('nextPageToken')
+            if not next_page:
                 break
 
         return playlist_items
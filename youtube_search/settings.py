@@ -11,103 +11,54 @@ __licence__ = 'MIT'
 
 import os
 
+from dataclasses import dataclass, field
 from pathlib import Path
 
 
+# Paths used to save states between runs, resolved once at import.
+CONFIG_PATH = os.path.join(
+    str(Path.home()), '.config', 'youtube_subscription_search')
+CREDENTIALS_FILE = os.path.join(CONFIG_PATH, 'credentials')
+LAST_RUN_FILE = os.path.join(CONFIG_PATH, 'last_run')
+SUBS_FILE = os.path.join(CONFIG_PATH, 'subscriptions')
+DEST_PL_FILE = os.path.join(CONFIG_PATH, 'dest_playlist')
+SEEN_DB_FILE = os.path.join(CONFIG_PATH, 'seen.db')
+
+
+@dataclass(frozen=True)
 class Settings(object):
     """Settings class to hold various static values for YouTube Search.
     """
 
-    def __init__(self):
-        """Initialise all properties.
-        """
-        # YouTube API settings.
-        self._api_service_name = 'youtube'
-        self._api_version = 'v3'
-        self._api_scopes = ['https://www.googleapis.com/auth/youtube']
-
-        # Files used to save states between runs.
-        self._config_path = os.path.join(
-            str(Path.home()), '.config', 'youtube_subscription_search')
-        self._credentials_file = os.path.join(self._config_path, 'credentials')
-        self._last_run_file = os.path.join(self._config_path, 'last_run')
-        self._subs_file = os.path.join(self._config_path, 'subscriptions')
-        self._dest_pl_file = os.path.join(self._config_path, 'dest_playlist')
-
-        # If last_run doesn't exist, set this many days ago to default value.
-        self._last_run_days_ago = 3
-        # Buffer for last_run to compare to new videos, in minutes.
-        self._last_run_buffer = 1440
-        # If subscriptions are this many days old, force a sub refresh.
-        self._subs_days_old = 14
-
-    @property
-    def api_service_name(self):
-        """The API Service name, 'youtube'
-        """
-        return self._api_service_name
-
-    @property
-    def api_version(self):
-        """The API version, 'v3'
-        """
-        return self._api_version
-
-    @property
-    def api_scopes(self):
-        """The API scope, ['https://www.googleapis.com/auth/youtube']
-        """
-        return self._api_scopes
-
-    @property
-    def config_path(self):
-        """The configuration path, ${HOME}/.config/youtube_subscription_search
-        """
-        return self._config_path
-
-    @property
-    def credentials_file(self):
-        """File containing saved credentials, <config_path>/credentials
-        """
-        return self._credentials_file
-
-    @property
-    def last_run_file(self):
-        """File containing last run information, <config_path>/last_run
-        """
-        return self._last_run_file
-
-    @property
-    def subs_file(self):
-        """File containing cached subscriptions, <config_path>/subscriptions
-        """
-        return self._subs_file
-
-    @property
-    def dest_pl_file(self):
-        """File containing the playlist to save videos to,
-        <config_path>/dest_playlist
-        """
-        return self._dest_pl_file
-
-    @property
-    def last_run_days_ago(self):
-        """If last_run doesn't exist, set this many days ago to run off of
-        default = 3
-        """
-        return self._last_run_days_ago
-
-    @property
-    def last_run_buffer(self):
-        """Buffer for last_run to compare to new videos, in minutes.
-        default = 180
-        """
-        return self._last_run_buffer
-
-    @property
-    def subs_days_old(self):
-        """If subscriptions are this many days old, force a sub refresh.
-        default = 14
-        """
-        return self._subs_days_old
-
+    # YouTube API settings.
+    # The API Service name, 'youtube'
+    api_service_name: str = 'youtube'
+    # The API version, 'v3'
+    api_version: str = 'v3'
+    # The API scope, ['https://www.googleapis.com/auth/youtube']
+    api_scopes: list = field(
+        default_factory=lambda: ['https://www.googleapis.com/auth/youtube'])
+
+    # Files used to save states between runs.
+    # The configuration path, ${HOME}/.config/youtube_subscription_search
+    config_path: str = CONFIG_PATH
+    # File containing saved credentials, <config_path>/credentials
+    credentials_file: str = CREDENTIALS_FILE
+    # File containing last run information, <config_path>/last_run
+    last_run_file: str = LAST_RUN_FILE
+    # File containing cached subscriptions, <config_path>/subscriptions
+    subs_file: str = SUBS_FILE
+    # File containing the playlist to save videos to,
+    # <config_path>/dest_playlist
+    dest_pl_file: str = DEST_PL_FILE
+    # Database of videos found in previous runs, <config_path>/seen.db
+    seen_db_file: str = SEEN_DB_FILE
+
+    # If last_run doesn't exist, set this many days ago to run off of.
+    last_run_days_ago: int = 3
+    # Buffer for last_run to compare to new videos, in minutes.
+    last_run_buffer: int = 1440
+    # If subscriptions are this many days old, force a sub refresh.
+    subs_days_old: int = 14
+    # Maximum number of batch requests to send concurrently.
+    max_workers: int = 4
@@ -2,7 +2,8 @@
 # -*- encoding: utf-8; py-indent-offset: 4 -*-
 """
 File: config_view.py
-Description: Prints out the youtube_subscription_search configuraiton in JSON.
+Description: Prints out the youtube_subscription_search configuraiton as a
+    JSON array.
 """
 
 
@@ -11,13 +12,13 @@ __copyright__ = '(c) Chris Pedro 2020'
 __licence__ = 'MIT'
 
 
-import json
-import pickle
+import orjson
+import os
 import sys
 
 from google.oauth2.credentials import Credentials
 from signal import signal, SIGINT
-from youtube_search import YouTubeSearch
+from youtube_search import YouTubeSearch, dumps
 
 
 def main(args):
@@ -26,47 +27,46 @@ def main(args):
     api = YouTubeSearch()
     settings = api.settings
 
-    with open(settings.credentials_file, 'rb') as fp:
-        credentials = pickle.load(fp)
-        if isinstance(credentials, Credentials):
-            print(json.dumps({
-                'configuration': 'Credentials',
-                'config_file': settings.credentials_file,
-                'token': credentials.token,
-                'expiry': str(credentials.expiry),
-                '_scopes': credentials._scopes,
-                '_id_token': credentials._id_token,
-                '_token_uri': credentials._token_uri,
-                '_client_id': credentials._client_id,
-                '_client_secret': credentials._client_secret,
-                '_quota_project_id': credentials._quota_project_id}))
-
-    with open(settings.last_run_file, 'rb') as fp:
+    config = []
+
+    credentials = api.load_credentials()
+    if isinstance(credentials, Credentials):
+        creds = {
+            'configuration': 'Credentials',
+            'config_file': settings.credentials_file}
+        creds.update(orjson.loads(credentials.to_json()))
+        # Not every google-auth version includes these in to_json().
+        creds['token'] = credentials.token
+        creds['expiry'] = credentials.expiry
+        config.append(creds)
+
+    # Without a last run file, load_last_run makes up a default, which isn't
+    # saved configuration.
+    if os.path.exists(settings.last_run_file):
         last_run = {
             'configuration': 'Last Run',
             'config_file': settings.last_run_file}
-        last_run.update(pickle.load(fp))
-        last_run['last_run'] = last_run['last_run'].strftime(
-            '%Y-%m-%d %H:%M:%S%Z')
-        print(json.dumps(last_run))
-
-    with open(settings.dest_pl_file, 'rb') as fp:
-        dest_playlist = {
-            'configuration': 'Destination Playlist',
-            'config_file': settings.dest_pl_file}
-        dest_playlist.update(pickle.load(fp))
-        dest_playlist['last_update'] = dest_playlist['last_update'].strftime(
-            '%Y-%m-%d %H:%M:%S%Z')
-        print(json.dumps(dest_playlist))
-
-    with open(settings.subs_file, 'rb') as fp:
-        subs = {
-            'configuration': 'Subscriptions',
-            'config_file': settings.subs_file}
-        subs.update(pickle.load(fp))
-        subs['last_update'] = subs['last_update'].strftime(
-            '%Y-%m-%d %H:%M:%S%Z')
-        print(json.dumps(subs))
+        last_run.update(api.load_last_run())
+        config.append(last_run)
+
+    config.append({
+        'configuration': 'Seen Videos',
+        'config_file': settings.seen_db_file,
+        'found_videos': sorted(api.load_seen_videos())})
+
+    dest_playlist = {
+        'configuration': 'Destination Playlist',
+        'config_file': settings.dest_pl_file}
+    dest_playlist.update(api.load_dest_playlist())
+    config.append(dest_playlist)
+
+    subs = {
+        'configuration': 'Subscriptions',
+        'config_file': settings.subs_file}
+    subs.update(api.load_subscriptions())
+    config.append(subs)
+
+    sys.stdout.write(dumps(config) + '\n')
 
 
 def handler(signal_received, frame):
@@ -13,15 +13,41 @@ __licence__ = 'MIT'
 
 
 import argparse
-import dateutil.parser
-import googleapiclient.discovery
-import googleapiclient.errors
-import json
+import logging
 import sys
 
 from datetime import datetime, timedelta, timezone
 from signal import signal, SIGINT
-from youtube_search import YouTubeSearch
+from youtube_search import YouTubeSearch, dumps, is_transient_error
+from youtube_search.settings import Settings
+
+
+log = logging.getLogger(__name__)
+
+
+class LazyJSON(object):
+    """Wraps an object to be dumped as JSON in a log message.  The object is
+    only dumped if the message is actually logged.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return dumps(self.obj)
+
+
+def positive_int(value):
+    """Argument type for a whole number greater than zero.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f'must be a whole number greater than 0: {value!r}')
+    return number
 
 
 def parse_args(args):
@@ -43,6 +69,10 @@ def parse_args(args):
     parser.add_argument(
         '-R', '--just-refresh-subscriptions', action='store_true',
         help='Refresh subscriptions, and do not search subs.')
+    parser.add_argument(
+        '-c', '--concurrency', type=positive_int,
+        help='Number of batch requests to send at once '
+             f'(default: {Settings.max_workers}).')
     parser.add_argument(
         '-v', '--verbose', action='store_true', help='Verbose output')
     parser.add_argument(
@@ -54,15 +84,14 @@ def ask_for_dest_playlist(api, args):
     """Prompt user for which playlist to save videos to.
     """
     playlists = api.get_user_playlists()
-    if args.debug:
-        print(json.dumps(playlists), file=sys.stderr)
+    log.debug('%s', LazyJSON(playlists))
 
     good_index = False
     while not good_index:
         try:
             print('Your playlists:')
             for i, pl in enumerate(playlists):
-                print('  {}: {}'.format(i, pl['snippet']['title']))
+                print(f"  {i}: {pl['snippet']['title']}")
             pl = int(input('Enter playlist index: '))
         except ValueError:
             continue
@@ -86,14 +115,16 @@ def get_user_subs(api, args):
     """Get the user's subscriptions.
     """
     if not args.refresh_subscriptions and not args.just_refresh_subscriptions:
+        # Subscriptions updated before this are too old, and are refreshed.
+        oldest_update = datetime.now(timezone.utc) - timedelta(
+            days=api.settings.subs_days_old)
         try:
             s_subs = api.load_subscriptions()
             # Backwards compatibility w/ <v0.2.0, will force sub reload.
             if type(s_subs) in [dict, set]:
                 if 'last_update' not in s_subs:
                     return s_subs['subscriptions']
-                elif (s_subs['last_update'] > datetime.now(timezone.utc)
-                      - timedelta(days=api.settings.subs_days_old)):
+                elif s_subs['last_update'] > oldest_update:
                     return s_subs['subscriptions']
         except FileNotFoundError:
             pass
@@ -108,98 +139,112 @@ def get_new_videos(api, args, subs, last_runtime):
     """Get new viedoes uploaded since last run from subscriptions.
     """
     if args.verbose:
-        msg = 'Last run: {}\n'
-        'Searching {} channels for new videos.\n'
-        '=========================================================='
-        print((msg.format(
-            last_runtime.strftime('%Y-%m-%d %H:%M:%S%Z'), len(subs))))
+        print(f'Last run: {last_runtime:%Y-%m-%d %H:%M:%S%Z}\n'
+              f'Searching {len(subs)} channels for new videos.\n'
+              '==========================================================')
+
+    # Give a bit of a buffer to last run. This is needed because videos
+    # sometimes take a while to appear in the API.
+    published_after = last_runtime - timedelta(
+        minutes=api.settings.last_run_buffer)
+
+    uploads = api.get_channels_uploads(
+        subs, published_after, max_workers=args.concurrency)
 
     new_videos = []
+    # The same video can show up more than once, only keep the first.  Video
+    # IDs are used as batch request IDs, which have to be unique.
+    video_ids = set()
+    # Verbose output is written in one go after the loop.
+    log_lines = []
     for channel in subs:
-        if args.verbose:
-            print('Searching {}.'.format(channel['title']))
-        uploads = api.get_channel_uploads(channel)
-        channel_videos = []
-
-        if args.debug:
-            print(json.dumps(uploads), file=sys.stderr)
-
-        for video in uploads:
-            details = video['contentDetails']
-            # Bug fix, some videos seem to not have a published date?  Seems to
-            # happen with privated videos, so just skip them.
-            if 'videoPublishedAt' not in details:
-                continue
-            published = dateutil.parser.isoparse(details['videoPublishedAt'])
-            # Give a bit of a buffer to last run. This is needed because videos
-            # sometimes take a while to appear in the API.
-            if published > last_runtime - timedelta(
-                    minutes=api.settings.last_run_buffer):
-                channel_videos.append(details)
+        channel_videos = uploads[channel.channel_id]
+
+        log.debug('%s', LazyJSON(channel_videos))
 
         if args.verbose:
-            print('  Found {} videos.'.format(len(channel_videos)))
+            log_lines.append(f'Searching {channel.title}.')
+            log_lines.append(f'  Found {len(channel_videos)} videos.')
+
+        for video in channel_videos:
+            if video.video_id not in video_ids:
+                video_ids.add(video.video_id)
+                new_videos.append(video)
 
-        new_videos.extend(channel_videos)
+    if log_lines:
+        sys.stdout.write('\n'.join(log_lines) + '\n')
 
     return new_videos
 
 
 def add_new_videos_to_playlist(api, pl_name, pl_id, new_videos, last_videos):
     """Add all new videos to the selected playlist to be watched later.
+    Returns the IDs of videos that were added or can't be added.  Videos that
+    failed with transient errors are left out, to be tried again next run.
     """
+    done = []
     if len(new_videos):
-        print(('==========================================================\n'
-               'Adding {} videos to {}'.format(len(new_videos), pl_name)))
+        print('==========================================================\n'
+              f'Adding {len(new_videos)} videos to {pl_name}')
 
         added = 0
         skipped = 0
+        video_ids = []
         for video in new_videos:
-            if video in last_videos:
+            if video.video_id in last_videos:
                 skipped += 1
                 continue
-            try:
-                api.add_video_to_playlist(video['videoId'], pl_id)
+            video_ids.append(video.video_id)
+
+        errors = api.add_videos_to_playlist(video_ids, pl_id)
+        for video_id, e in errors.items():
+            if e is None:
                 added += 1
-            except googleapiclient.errors.HttpError as e:
+            else:
                 print(e)
                 skipped += 1
+            if not is_transient_error(e):
+                done.append(video_id)
 
-        print(('==========================================================\n'
-               '{} videos added.\n'
-               '{} videos already added to playlist.').format(added, skipped))
+        print('==========================================================\n'
+              f'{added} videos added.\n'
+              f'{skipped} videos already added to playlist.')
     else:
-        print(('==========================================================\n'
-               'No videos to add.'))
+        print('==========================================================\n'
+              'No videos to add.')
+
+    return done
 
 
 def main(args):
     """Main method.
     """
     args = parse_args(args)
+    # Debug output is logged as JSON to sys.stderr.  Only this program's
+    # logger is set to debug, not the Google client libraries'.
+    logging.basicConfig(format='%(message)s')
+    log.setLevel(logging.DEBUG if args.debug else logging.WARNING)
     api = YouTubeSearch(secrets_file=args.secrets_file)
 
-    last_run = api.load_last_run()
-    last_runtime = last_run['last_run']
-    last_videos = last_run['found_videos']
+    last_runtime = api.load_last_run()['last_run']
+    api.migrate_seen_videos()
+    last_videos = api.load_seen_videos()
 
     pl_id, pl_name = get_dest_playlist(api, args)
     if args.just_set_playlist:
         return
 
     subs = get_user_subs(api, args)
-    if args.debug:
-        print(json.dumps(subs), file=sys.stderr)
+    log.debug('%s', LazyJSON(subs))
     if args.just_refresh_subscriptions:
         return
 
     new_videos = get_new_videos(api, args, subs, last_runtime)
-    if args.debug:
-        print(json.dumps(new_videos), file=sys.stderr)
-
-    add_new_videos_to_playlist(api, pl_name, pl_id, new_videos, last_videos)
+    log.debug('%s', LazyJSON(new_videos))
 
-    api.save_last_run(new_videos)
+    api.save_seen_videos(add_new_videos_to_playlist(
+        api, pl_name, pl_id, new_videos, last_videos))
+    api.save_last_run()
 
 
 def handler(signal_received, frame):